@@ -112,7 +112,10 @@ async def _oauth2_refresh(
 
 
 async def execute_oauth2_flow(
-    session: aiohttp.ClientSession, authorization: Optional[Dict[str, Any]]
+    session: aiohttp.ClientSession,
+    authorization: Optional[Dict[str, Any]],
+    *,
+    force_refresh: bool = False,
 ) -> Dict[str, Any]:
     if not authorization:
         authorization = await _oauth2_authorize(
@@ -122,7 +125,7 @@ async def execute_oauth2_flow(
             # https://dev.fitbit.com/build/reference/web-api/developer-guide/application-design/#Scopes
             scope="activity heartrate location weight",
         )
-    elif datetime.now() > datetime.fromtimestamp(
+    elif force_refresh or datetime.now() > datetime.fromtimestamp(
         authorization["ts"] + authorization["expires_in"]
     ):
         authorization = await _oauth2_refresh(
@@ -186,13 +189,15 @@ async def get_activity_calories(
 ) -> bytes:
     headers = fitbit_api.get_custom_authorization_headers()
     async with _API_RATE_LIMITER:
-        async with session.get(url, headers=headers) as res:
+        async with session.get(url, headers=headers, raise_for_status=False) as res:
             if res.status == 200:
                 return await res.read()
             elif res.status == 400:
                 fallback_url = url.split("1min/time", 1)[0] + "1min.json"
                 print(f"Falling back to truncated url for calories: {fallback_url}")
-                async with session.get(fallback_url, headers=headers) as fallback_res:
+                async with session.get(
+                    fallback_url, headers=headers, raise_for_status=False
+                ) as fallback_res:
                     if fallback_res.status == 200:
                         return await fallback_res.read()
     return None  # type: ignore[return-value]
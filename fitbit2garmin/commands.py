@@ -1,60 +1,222 @@
 import asyncio
+import concurrent.futures
 import functools
-import json
 import logging
-import os
 import pathlib
+import random
 
 from collections.abc import Callable, Coroutine
 from datetime import date, datetime
-from typing import Any
+from typing import Any, Dict, Final, Optional, Tuple
 
 import aiohttp
+import orjson
 
 from dateutil.relativedelta import relativedelta
 from dateutil.rrule import MONTHLY, rrule
 
 from . import aiohttp_fitbit_api, create_fit, create_tcx
 
+_API_MAX_ATTEMPTS: Final[int] = 5
+_API_RETRY_STATUSES: Final[frozenset[int]] = frozenset({429, 500, 502, 503, 504})
+
+
+# Keeps the OAuth2 token in memory for the whole run, the auth file is only
+# read once and written back when the token changes.
+class _Authorization:
+    def __init__(self, session: aiohttp.ClientSession, auth_file_path: pathlib.Path):
+        self._session = session
+        self._auth_file_path = auth_file_path
+        self._authorization: Optional[Dict[str, Any]] = None
+        self._lock = asyncio.Lock()
+
+    async def get_bearer_token(self) -> str:
+        async with self._lock:
+            if self._authorization is None and self._auth_file_path.exists():
+                with self._auth_file_path.open("rb") as fr:
+                    self._authorization = orjson.loads(fr.read())
+            await self._update(force_refresh=False)
+            assert self._authorization
+            return self._authorization["access_token"]
+
+    async def refresh(self, bearer_token: str) -> None:
+        async with self._lock:
+            # Another request may have already refreshed the rejected token.
+            if (
+                self._authorization
+                and self._authorization["access_token"] == bearer_token
+            ):
+                await self._update(force_refresh=True)
+
+    async def _update(self, *, force_refresh: bool) -> None:
+        authorization = await aiohttp_fitbit_api.execute_oauth2_flow(
+            self._session, self._authorization, force_refresh=force_refresh
+        )
+        if authorization is not self._authorization:
+            with self._auth_file_path.open("w") as fw:
+                print(orjson.dumps(authorization).decode(), file=fw)
+            self._authorization = authorization
+
+
+def _get_retry_delay(
+    attempt: int, err: Optional[aiohttp.ClientResponseError] = None
+) -> float:
+    # Honor the server's Retry-After (in seconds) when it sends one.
+    retry_after = err.headers.get("Retry-After") if err and err.headers else None
+    if retry_after and retry_after.isdigit():
+        return float(retry_after)
+    return 2**attempt + random.random()
+
 
 def run_aiohttp_fitbit_api_call(
     name: str,
-    auth_file_path: pathlib.Path,
+    session: aiohttp.ClientSession,
+    authorization: _Authorization,
     func: Callable[..., Coroutine[Any, Any, Any]],
-    *,
-    raise_for_status: bool = True,
+    uses_bearer_token: bool = True,
 ):
     @functools.wraps(func)
     async def wrapper(*args, **kwargs):
-        async with aiohttp.ClientSession(raise_for_status=raise_for_status) as session:
-            while True:
-                try:
-                    logging.debug(f"{name}: Authorizing request.")
-                    if auth_file_path.exists():
-                        with auth_file_path.open("r") as fr:
-                            authorization = json.loads(fr.read())
-                    else:
-                        authorization = None
-                    authorization = await aiohttp_fitbit_api.execute_oauth2_flow(
-                        session, authorization
+        for attempt in range(1, _API_MAX_ATTEMPTS + 1):
+            bearer_token = None
+            try:
+                logging.debug(f"{name}: Authorizing request.")
+                bearer_token = await authorization.get_bearer_token()
+                logging.debug(f"{name}: Sending request.")
+                result = await func(session, bearer_token, *args, **kwargs)
+            except aiohttp.ClientResponseError as err:
+                logging.error(f"{name}: Request failed: {err}")
+                if err.status == 401 and not uses_bearer_token:
+                    # Refreshing the OAuth2 token can't fix the UI token.
+                    logging.error(
+                        f"{name}: The UI token in fitbit_api.py was rejected, "
+                        "update it and rerun."
                     )
-                    with auth_file_path.open("w") as fw:
-                        print(json.dumps(authorization), file=fw)
-                    bearer_token = authorization["access_token"]
-                    logging.debug(f"{name}: Sending request.")
-                    result = await func(session, bearer_token, *args, **kwargs)
-                except aiohttp.ClientResponseError as err:
-                    logging.error(f"{name}: Request failed: {err}")
-                    continue
-                except asyncio.TimeoutError:
-                    logging.error(f"{name}: Request timed out.")
-                    continue
-                logging.debug(f"{name}: Done.")
-                return result
+                if attempt == _API_MAX_ATTEMPTS:
+                    raise
+                if err.status == 401 and uses_bearer_token and bearer_token:
+                    await authorization.refresh(bearer_token)
+                elif err.status in _API_RETRY_STATUSES:
+                    await asyncio.sleep(_get_retry_delay(attempt, err))
+                else:
+                    raise
+                continue
+            except asyncio.TimeoutError:
+                logging.error(f"{name}: Request timed out.")
+                if attempt == _API_MAX_ATTEMPTS:
+                    raise
+                await asyncio.sleep(_get_retry_delay(attempt))
+                continue
+            logging.debug(f"{name}: Done.")
+            return result
 
     return wrapper
 
 
+def _at_most_n_newlines(buf: bytes, n: int) -> bool:
+    # Same as buf.count(b"\n") <= n, but stops scanning after n + 1 newlines.
+    idx = -1
+    for _ in range(n + 1):
+        idx = buf.find(b"\n", idx + 1)
+        if idx == -1:
+            return True
+    return False
+
+
+async def _process_activity(
+    activity: dict[str, Any],
+    i: int,
+    session: aiohttp.ClientSession,
+    sem: asyncio.Semaphore,
+    *,
+    num_activities: int,
+    tcxs_directory: pathlib.Path,
+    authorization: _Authorization,
+    is_tcx: bool,
+) -> Optional[Tuple[pathlib.Path, pathlib.Path, pathlib.Path, pathlib.Path]]:
+    activity_number = i + 1
+    progress = f"[{activity_number}/{num_activities}]"
+    log_id = activity["logId"]
+    activity_dir = tcxs_directory / str(log_id)
+    activity_dir.mkdir(parents=True, exist_ok=True)
+    activity_file_path = activity_dir / "exercise-activity.json"
+    activity_heart_rate_file_path = activity_dir / "exercise-heart-rate.json"
+    activity_calories_file_path = activity_dir / "exercise-calories.json"
+    if is_tcx:
+        output_file_path = tcxs_directory / f"exercise-{log_id}.tcx"
+    else:
+        output_file_path = tcxs_directory / f"exercise-{log_id}.fit"
+
+    if output_file_path.exists() and activity_heart_rate_file_path.exists():
+        logging.info(f"{progress} Activity {log_id} already converted, skipping.")
+        return None
+
+    logging.info(f"{progress} Fetching activity {log_id}.")
+    get_activity_tcx = run_aiohttp_fitbit_api_call(
+        f"{progress} activity-tcx-{log_id}",
+        session,
+        authorization,
+        aiohttp_fitbit_api.get_activity_tcx,
+    )
+    async with sem:
+        tcx = await get_activity_tcx(log_id)
+    heart_rate_url = activity.get("heartRateLink", "missing")
+
+    # Create json file for activity
+    if not activity_file_path.exists():
+        with activity_file_path.open("wb") as fw:
+            fw.write(orjson.dumps(activity))
+
+    if (
+        activity["logType"] == "auto_detected" or _at_most_n_newlines(tcx, 15)
+    ) and heart_rate_url != "missing":
+        logging.info(f"{progress} Heart rate url found: {heart_rate_url}")
+        if not activity_heart_rate_file_path.exists():
+            get_activity_heart_rate = run_aiohttp_fitbit_api_call(
+                f"{progress} activity-heart-rate-{log_id}",
+                session,
+                authorization,
+                aiohttp_fitbit_api.get_activity_heart_rate,
+                uses_bearer_token=False,
+            )
+            async with sem:
+                heart_rate = await get_activity_heart_rate(heart_rate_url)
+            # Create json file for activity heart rate
+            with activity_heart_rate_file_path.open("wb") as fw:
+                fw.write(heart_rate)
+
+        calories_url = activity.get("caloriesLink", "missing")
+        if calories_url != "missing":
+            logging.info(f"{progress} Calories url found: {calories_url}")
+            if not activity_calories_file_path.exists():
+                get_activity_calories = run_aiohttp_fitbit_api_call(
+                    f"{progress} activity-calories-{log_id}",
+                    session,
+                    authorization,
+                    aiohttp_fitbit_api.get_activity_calories,
+                    uses_bearer_token=False,
+                )
+                async with sem:
+                    calories = await get_activity_calories(calories_url)
+                if calories != None:
+                    # Create json file for activity heart rate
+                    with activity_calories_file_path.open("wb") as fw:
+                        fw.write(calories)
+
+        return (
+            activity_heart_rate_file_path,
+            activity_calories_file_path,
+            activity_file_path,
+            output_file_path,
+        )
+    else:
+        logging.warning(
+            f"{progress} Skipping exercise {log_id} for {activity.get('activityName', 'Empty')}, "
+            f"see {activity_file_path} to add it manually."
+        )
+        return None
+
+
 async def create_activity_tcx_or_fit(
     cache_directory: pathlib.Path,
     tcxs_directory: pathlib.Path,
@@ -68,95 +230,90 @@ async def create_activity_tcx_or_fit(
     auth_file_name = ".auth"
     auth_file_path = cache_directory / auth_file_name
 
-    # Fetch activity log.
-    date_range = f"{start_date}-{end_date}"
-    activity_log_file_path = cache_directory / f".exercises.{date_range}.jsonl"
-    activity_log_done_file_path = cache_directory / f".exercises.{date_range}"
-    if not activity_log_file_path.exists() or not activity_log_done_file_path.exists():
-        get_activity_log_list = run_aiohttp_fitbit_api_call(
-            "activity-log-list",
-            auth_file_path,
-            aiohttp_fitbit_api.get_activity_log_list,
-        )
-        logging.info("Fetching activity log list.")
-        activities = await get_activity_log_list(start_date, end_date)
-        with activity_log_file_path.open("w") as fw:
-            for activity in activities:
-                print(json.dumps(activity), file=fw)
-        activity_log_done_file_path.touch()
-        logging.info("Activity log list fetched.")
-
-    # Count number of activities.
-    with activity_log_file_path.open("r") as fr:
-        num_activities = sum(1 for _ in fr)
-
-    # Fetch tcx for each activity.
-    with activity_log_file_path.open("r") as fr:
-        for i, activity in enumerate(map(json.loads, fr)):
-            activity_number = i + 1
-            progress = f"[{activity_number}/{num_activities}]"
-            log_id = activity["logId"]
-            if not os.path.isdir(f"{tcxs_directory}/{log_id}"):
-                os.mkdir(f"{tcxs_directory}/{log_id}")
-
-            logging.info(f"{progress} Fetching activity {log_id}.")
-            get_activity_tcx = run_aiohttp_fitbit_api_call(
-                f"{progress} activity-tcx-{log_id}",
-                auth_file_path,
-                aiohttp_fitbit_api.get_activity_tcx,
+    connector = aiohttp.TCPConnector(limit=10, limit_per_host=6, keepalive_timeout=75)
+    async with aiohttp.ClientSession(
+        raise_for_status=True, connector=connector
+    ) as session:
+        authorization = _Authorization(session, auth_file_path)
+        logging.info("Authorizing.")
+        await authorization.get_bearer_token()
+
+        # Fetch activity log.
+        date_range = f"{start_date}-{end_date}"
+        activity_log_file_path = cache_directory / f".exercises.{date_range}.json"
+        activity_log_done_file_path = cache_directory / f".exercises.{date_range}"
+        if (
+            not activity_log_file_path.exists()
+            or not activity_log_done_file_path.exists()
+        ):
+            get_activity_log_list = run_aiohttp_fitbit_api_call(
+                "activity-log-list",
+                session,
+                authorization,
+                aiohttp_fitbit_api.get_activity_log_list,
+            )
+            logging.info("Fetching activity log list.")
+            activities = await get_activity_log_list(start_date, end_date)
+            with activity_log_file_path.open("wb") as fw:
+                fw.write(orjson.dumps(activities))
+            activity_log_done_file_path.touch()
+            logging.info("Activity log list fetched.")
+        else:
+            with activity_log_file_path.open("rb") as fr:
+                activities = orjson.loads(fr.read())
+        num_activities = len(activities)
+
+        # Fetch tcx for each activity, a few activities at a time.
+        sem = asyncio.Semaphore(8)
+        tasks = [
+            _process_activity(
+                activity,
+                i,
+                session,
+                sem,
+                num_activities=num_activities,
+                tcxs_directory=tcxs_directory,
+                authorization=authorization,
+                is_tcx=is_tcx,
             )
-            tcx = await get_activity_tcx(log_id)
-            heart_rate_url = activity.get("heartRateLink", "missing")
+            for i, activity in enumerate(activities)
+        ]
+        # A failing activity must not abort the others, nor leave them running
+        # once the session is closed.
+        results = await asyncio.gather(*tasks, return_exceptions=True)
 
-            # Create json file for activity
-            activity_file_path = tcxs_directory / f"{log_id}" / "exercise-activity.json"
-            if not activity_file_path.exists():
-                with activity_file_path.open("w") as fw:
-                    json.dump(activity, fw)
+    to_create = []
+    for activity, result in zip(activities, results):
+        if isinstance(result, (aiohttp.ClientError, asyncio.TimeoutError)):
+            # Already logged and retried by run_aiohttp_fitbit_api_call.
+            logging.error(
+                f"Giving up on activity {activity['logId']}, rerun to retry it."
+            )
+        elif isinstance(result, Exception):
+            logging.error(
+                f"Failed to fetch activity {activity['logId']}.", exc_info=result
+            )
+        elif isinstance(result, BaseException):
+            raise result
+        elif result is not None:
+            to_create.append(result)
 
-            if (
-                activity["logType"] == "auto_detected" or tcx.count(b"\n") <= 15
-            ) and heart_rate_url != "missing":
-                logging.info(f"{progress} Heart rate url found: {heart_rate_url}")
-                activity_heart_rate_file_path = (
-                    tcxs_directory / f"{log_id}" / "exercise-heart-rate.json"
-                )
-                if not activity_heart_rate_file_path.exists():
-                    get_activity_heart_rate = run_aiohttp_fitbit_api_call(
-                        f"{progress} activity-heart-rate-{log_id}",
-                        auth_file_path,
-                        aiohttp_fitbit_api.get_activity_heart_rate,
-                    )
-                    heart_rate = await get_activity_heart_rate(heart_rate_url)
-                    # Create json file for activity heart rate
-                    with activity_heart_rate_file_path.open("wb") as fw:
-                        fw.write(heart_rate)
-
-                calories_url = activity.get("caloriesLink", "missing")
-                if calories_url != "missing":
-                    logging.info(f"{progress} Calories url found: {calories_url}")
-                    activity_calories_file_path = (
-                        tcxs_directory / f"{log_id}" / "exercise-calories.json"
-                    )
-                    if not activity_calories_file_path.exists():
-                        get_activity_calories = run_aiohttp_fitbit_api_call(
-                            f"{progress} activity-calories-{log_id}",
-                            auth_file_path,
-                            aiohttp_fitbit_api.get_activity_calories,
-                            raise_for_status=False,
-                        )
-                        calories = await get_activity_calories(calories_url)
-                        if calories != None:
-                            # Create json file for activity heart rate
-                            with activity_calories_file_path.open("wb") as fw:
-                                fw.write(calories)
-
-                if is_tcx:
-                    create_tcx.create_tcx(log_id)
-                else:
-                    create_fit.create_fit(log_id)
-            else:
-                logging.info(
-                    f"{progress} Skipping exercise {log_id} for {activity.get('activityName', 'Empty')}"
-                )
-                input("Press Enter to continue...")
+    # Create tcx/fit for the fetched activities. This is CPU-bound, so spread
+    # it over one process per core.
+    if to_create:
+        create = create_tcx.create_tcx if is_tcx else create_fit.create_fit
+        logging.info(f"Creating {len(to_create)} {'tcx' if is_tcx else 'fit'} files.")
+        loop = asyncio.get_running_loop()
+        with concurrent.futures.ProcessPoolExecutor() as executor:
+            created = await asyncio.gather(
+                *(
+                    loop.run_in_executor(executor, create, *paths)
+                    for paths in to_create
+                ),
+                return_exceptions=True,
+            )
+        for paths, result in zip(to_create, created):
+            if isinstance(result, Exception):
+                logging.error(f"Failed to create {paths[3]}: {result!r}")
+            elif isinstance(result, BaseException):
+                raise result
@@ -1,56 +1,57 @@
-import json
 import os
-import statistics
-from datetime import datetime, timezone
-
-
-def create_fit(log_id: str):
-    # Import builder / message classes from fit-tool
-    from fit_tool.fit_file_builder import FitFileBuilder
-    from fit_tool.profile.messages.activity_message import ActivityMessage
-    from fit_tool.profile.messages.device_info_message import DeviceInfoMessage
-    from fit_tool.profile.messages.file_creator_message import FileCreatorMessage
-    from fit_tool.profile.messages.file_id_message import FileIdMessage
-    from fit_tool.profile.messages.lap_message import LapMessage
-    from fit_tool.profile.messages.record_message import RecordMessage
-    from fit_tool.profile.messages.session_message import SessionMessage
-    from fit_tool.profile.profile_type import (
-        DeviceIndex,
-        FileType,
-        GarminProduct,
-        Manufacturer,
-        Sport,
-        SubSport,
-    )
-
-    # === CONFIG ===
-    HEART_RATE_FILE = f"f2g/{log_id}/exercise-heart-rate.json"
-    CALORIES_FILE = f"f2g/{log_id}/exercise-calories.json"
-    ACTIVITY_FILE = f"f2g/{log_id}/exercise-activity.json"
-    OUTPUT_FILE = f"f2g/exercise-{log_id}.fit"
-
-    # Mapping Fitbit → FIT tool sport enum
-    FITBIT_TO_FIT_TOOL_SPORT = {
-        "Run": Sport.RUNNING,
-        "Walk": Sport.WALKING,
-        "Walking": Sport.WALKING,
-        "Hike": Sport.HIKING,
-        "Bike": Sport.CYCLING,
-        "Biking": Sport.CYCLING,
-        "Outdoor Bike": Sport.CYCLING,
-        "Treadmill": Sport.RUNNING,
-        "Elliptical": Sport.FITNESS_EQUIPMENT,
-        "Swim": Sport.SWIMMING,
-        "Strength Training": Sport.FITNESS_EQUIPMENT,
-        "Workout": Sport.FITNESS_EQUIPMENT,
-        "Weights": Sport.FITNESS_EQUIPMENT,
-        "Aerobic Workout": Sport.SOCCER,
-        "Sport": Sport.SOCCER,
-        # Add more as needed
-    }
-
-    # Activities where distance is relevant
-    DISTANCE_RELEVANT = {
+import pathlib
+from datetime import timezone
+from typing import Dict, Final
+
+from fit_tool.fit_file_builder import FitFileBuilder
+from fit_tool.message import Message
+from fit_tool.profile.messages.activity_message import ActivityMessage
+from fit_tool.profile.messages.device_info_message import DeviceInfoMessage
+from fit_tool.profile.messages.file_creator_message import FileCreatorMessage
+from fit_tool.profile.messages.file_id_message import FileIdMessage
+from fit_tool.profile.messages.lap_message import LapMessage
+from fit_tool.profile.messages.record_message import RecordMessage
+from fit_tool.profile.messages.session_message import SessionMessage
+from fit_tool.profile.profile_type import (
+    DeviceIndex,
+    FileType,
+    GarminProduct,
+    Manufacturer,
+    Sport,
+    SubSport,
+)
+
+from . import parse_activity
+
+# Mapping Fitbit → FIT tool sport enum
+_FITBIT_TO_FIT_TOOL_SPORT: Final[Dict[str, Sport]] = {
+    "Run": Sport.RUNNING,
+    "Walk": Sport.WALKING,
+    "Walking": Sport.WALKING,
+    "Hike": Sport.HIKING,
+    "Bike": Sport.CYCLING,
+    "Biking": Sport.CYCLING,
+    "Outdoor Bike": Sport.CYCLING,
+    "Treadmill": Sport.RUNNING,
+    "Elliptical": Sport.FITNESS_EQUIPMENT,
+    "Swim": Sport.SWIMMING,
+    "Strength Training": Sport.FITNESS_EQUIPMENT,
+    "Workout": Sport.FITNESS_EQUIPMENT,
+    "Weights": Sport.FITNESS_EQUIPMENT,
+    "Aerobic Workout": Sport.SOCCER,
+    "Sport": Sport.SOCCER,
+    # Add more as needed
+}
+
+# Mapping Fitbit → FIT tool sub sport enum, for activities that have one
+_FITBIT_TO_FIT_TOOL_SUB_SPORT: Final[Dict[str, SubSport]] = {
+    "Weights": SubSport.STRENGTH_TRAINING,
+    "Elliptical": SubSport.ELLIPTICAL,
+}
+
+# Activities where distance is relevant
+_DISTANCE_RELEVANT: Final[frozenset[str]] = frozenset(
+    {
         "Run",
         "Walk",
         "Walking",
@@ -65,9 +66,11 @@ def create_fit(log_id: str):
         "Elliptical",
         "Aerobic Workout",
     }
+)
 
-    # Activities where elevation gain is relevant
-    ELEVATION_RELEVANT = {
+# Activities where elevation gain is relevant
+_ELEVATION_RELEVANT: Final[frozenset[str]] = frozenset(
+    {
         "Run",
         "Walk",
         "Walking",
@@ -83,37 +86,40 @@ def create_fit(log_id: str):
         "Aerobic Workout",
         "Sport",
     }
-
-    DEFAULT_STRIDE_LENGTH_M = 0.762
-
-    # Load data
-    with open(HEART_RATE_FILE) as f:
-        hr_data = json.load(f)
-
-    calorie_data = None
-    calories_available = False
-    try:
-        with open(CALORIES_FILE) as f:
-            calorie_data = json.load(f)
-            calories_available = True
-    except FileNotFoundError:
-        print("⚠️ Calories file not found — skipping per-minute calories")
-
-    with open(ACTIVITY_FILE) as f:
-        activity = json.load(f)
+)
+
+_DEFAULT_STRIDE_LENGTH_M: Final[float] = 0.762
+
+
+def create_fit(
+    heart_rate_file_path: pathlib.Path,
+    calories_file_path: pathlib.Path,
+    activity_file_path: pathlib.Path,
+    output_file_path: pathlib.Path,
+):
+    # Nothing to do if a previous run already converted this heart rate data
+    if (
+        output_file_path.exists()
+        and output_file_path.stat().st_mtime > heart_rate_file_path.stat().st_mtime
+    ):
+        print(f"✅ FIT file up to date: {os.path.abspath(output_file_path)}")
+        return
+
+    parsed = parse_activity.parse(
+        heart_rate_file_path, calories_file_path, activity_file_path
+    )
+    activity = parsed.activity
 
     # Parse metadata
-    start_time_str = activity["startTime"]
-    start_time = datetime.fromisoformat(start_time_str)  # timezone-aware
-    start_time_utc = start_time.astimezone(timezone.utc)
+    start_time_utc = parsed.start_time.astimezone(timezone.utc)
     duration_s = activity["duration"] / 1000.0
 
     # Handle distance / steps fallback
     distance_km = activity.get("distance", 0.0)
     steps = activity.get("steps", 0)
     if distance_km == 0.0:
-        if steps and activity.get("activityName") in DISTANCE_RELEVANT:
-            distance_km = (steps * DEFAULT_STRIDE_LENGTH_M) / 1000.0
+        if steps and activity.get("activityName") in _DISTANCE_RELEVANT:
+            distance_km = (steps * _DEFAULT_STRIDE_LENGTH_M) / 1000.0
             print(f"ℹ Estimated distance from {steps} steps: {distance_km:.3f} km")
         else:
             print(
@@ -123,46 +129,21 @@ def create_fit(log_id: str):
 
     # Elevation gain
     elevation_gain = 0
-    if activity.get("activityName") in ELEVATION_RELEVANT:
+    if activity.get("activityName") in _ELEVATION_RELEVANT:
         elevation_gain = int(round(activity.get("elevationGain", 0.0)))
 
     calories_total = activity.get("calories", 0)
 
     fitbit_activity = activity.get("activityName", "Workout")
-    fit_sport = FITBIT_TO_FIT_TOOL_SPORT.get(fitbit_activity, Sport.FITNESS_EQUIPMENT)
-
-    # Parse heart rate data
-    hr_times = []
-    hr_values = []
-    date_str = hr_data["activities-heart"][0]["dateTime"]
-    tz_offset = start_time_str[-6:]  # e.g. "-07:00"
+    fit_sport = _FITBIT_TO_FIT_TOOL_SPORT.get(fitbit_activity, Sport.FITNESS_EQUIPMENT)
+    fit_sub_sport = _FITBIT_TO_FIT_TOOL_SUB_SPORT.get(fitbit_activity)
 
-    for entry in hr_data["activities-heart-intraday"]["dataset"]:
-        time_part = entry["time"]  # "HH:MM:SS"
-        dt = datetime.fromisoformat(f"{date_str}T{time_part}{tz_offset}")
-        hr_times.append(dt)
-        hr_values.append(entry["value"])
-
-    if not hr_values:
-        raise RuntimeError("No heart rate data available")
-
-    min_hr = min(hr_values)
-    max_hr = max(hr_values)
-    avg_hr = round(statistics.mean(hr_values))
-
-    # Parse calorie intraday if available
-    cal_map = {}
-    if calories_available:
-        try:
-            base_date = calorie_data["activities-calories"][0]["dateTime"]  # type: ignore[index]
-            for entry in calorie_data["activities-calories-intraday"]["dataset"]:  # type: ignore[index]
-                t = entry["time"]
-                dt = datetime.fromisoformat(f"{base_date}T{t}{tz_offset}")
-                cal_map[dt.replace(second=0, microsecond=0)] = entry["value"]
-        except Exception as e:
-            print("⚠ Could not parse calorie intraday:", e)
-            cal_map = {}
-            calories_available = False
+    min_hr = parsed.min_hr
+    max_hr = parsed.max_hr
+    avg_hr = parsed.avg_hr
+    cal_map = parsed.cal_map
+    hr_timestamps_ms = parsed.hr_timestamps_ms.tolist()
+    hr_values = parsed.hr_values.tolist()
 
     # === Build FIT file ===
     builder = FitFileBuilder(auto_define=True)
@@ -208,10 +189,8 @@ def create_fit(log_id: str):
     lap.enhanced_avg_speed = distance_m / duration_s
     lap.total_ascent = elevation_gain
     lap.sport = fit_sport
-    if fitbit_activity == "Weights":
-        lap.sub_sport = SubSport.STRENGTH_TRAINING
-    elif fitbit_activity == "Elliptical":
-        lap.sub_sport = SubSport.ELLIPTICAL
+    if fit_sub_sport is not None:
+        lap.sub_sport = fit_sub_sport
     builder.add(lap)
 
     # Session message
@@ -231,10 +210,8 @@ def create_fit(log_id: str):
     sess.total_ascent = elevation_gain
     sess.sport = fit_sport
     sess.num_laps = 1
-    if fitbit_activity == "Weights":
-        sess.sub_sport = SubSport.STRENGTH_TRAINING
-    elif fitbit_activity == "Elliptical":
-        sess.sub_sport = SubSport.ELLIPTICAL
+    if fit_sub_sport is not None:
+        sess.sub_sport = fit_sub_sport
     builder.add(sess)
 
     # Activity message
@@ -245,19 +222,29 @@ def create_fit(log_id: str):
     builder.add(ac)
 
     # Record messages
-    for dt, hr in zip(hr_times, hr_values):
-        rec = RecordMessage()
-        rec.timestamp = round(dt.astimezone(timezone.utc).timestamp() * 1000)
-        rec.heart_rate = hr
-        if calories_available:
-            ck = dt.replace(second=0, microsecond=0)
-            cal_min = cal_map.get(ck)
+    records: list[Message] = []
+    if cal_map:
+        for ts_ms, hr in zip(hr_timestamps_ms, hr_values):
+            rec = RecordMessage()
+            rec.timestamp = ts_ms
+            rec.heart_rate = hr
+            cal_min = cal_map.get(ts_ms // 60000)
             if cal_min is not None:
-                rec.calories = cal_min / 60.0
-        builder.add(rec)
-
-    # Build FIT file object and save
+                rec.calories = cal_min / 60.0  # type: ignore[assignment]
+            records.append(rec)
+    else:
+        for ts_ms, hr in zip(hr_timestamps_ms, hr_values):
+            rec = RecordMessage()
+            rec.timestamp = ts_ms
+            rec.heart_rate = hr
+            records.append(rec)
+    builder.add_all(records)
+
+    # Build FIT file object and save, moving it into place once complete so
+    # an interrupted run never leaves a truncated FIT that looks converted.
     fit_file_obj = builder.build()
-    fit_file_obj.to_file(OUTPUT_FILE)
+    tmp_file_path = output_file_path.with_suffix(output_file_path.suffix + ".tmp")
+    fit_file_obj.to_file(str(tmp_file_path))
+    os.replace(tmp_file_path, output_file_path)
 
-    print("✅ FIT file written:", os.path.abspath(OUTPUT_FILE))
+    print("✅ FIT file written:", os.path.abspath(output_file_path))
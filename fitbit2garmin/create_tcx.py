@@ -1,33 +1,29 @@
-import json
 import os
-import statistics
+import pathlib
 import xml.etree.ElementTree as ET
-from datetime import datetime
-
-
-def create_tcx(log_id: str):
-    # === CONFIG ===
-    HEART_RATE_FILE = f"f2g/{log_id}/exercise-heart-rate.json"
-    CALORIES_FILE = f"f2g/{log_id}/exercise-calories.json"
-    ACTIVITY_FILE = f"f2g/{log_id}/exercise-activity.json"
-    OUTPUT_FILE = f"f2g/exercise-{log_id}.tcx"
-
-    # === Mapping Fitbit activity names to Garmin TCX Sport types ===
-    FITBIT_TO_GARMIN_SPORT = {
-        "Run": "Running",
-        "Walk": "Walking",
-        "Hike": "Hiking",
-        "Bike": "Biking",
-        "Swim": "Swimming",
-        "Treadmill": "Running",
-        "Elliptical": "Other",
-        "Yoga": "Other",
-        "Strength Training": "Other",
-        "Workout": "Other",
-        # Add more as needed
-    }
-
-    DISTANCE_RELEVANT_ACTIVITIES = {
+from typing import Dict, Final
+
+import numpy as np
+
+from . import parse_activity
+
+# === Mapping Fitbit activity names to Garmin TCX Sport types ===
+_FITBIT_TO_GARMIN_SPORT: Final[Dict[str, str]] = {
+    "Run": "Running",
+    "Walk": "Walking",
+    "Hike": "Hiking",
+    "Bike": "Biking",
+    "Swim": "Swimming",
+    "Treadmill": "Running",
+    "Elliptical": "Other",
+    "Yoga": "Other",
+    "Strength Training": "Other",
+    "Workout": "Other",
+    # Add more as needed
+}
+
+_DISTANCE_RELEVANT_ACTIVITIES: Final[frozenset[str]] = frozenset(
+    {
         "Run",
         "Walk",
         "Hike",
@@ -36,29 +32,44 @@ def create_tcx(log_id: str):
         "Swim",
         "Sport",
     }
-
-    DEFAULT_STRIDE_LENGTH_M = 0.762  # average adult stride
-
-    # === Load all data ===
-    with open(HEART_RATE_FILE, "r") as f:
-        hr_data = json.load(f)
-
-    try:
-        with open(CALORIES_FILE, "r") as f:
-            calorie_data = json.load(f)
-            calories_available = True
-    except FileNotFoundError:
-        print("⚠️  Calories file not found. Skipping per-minute calorie data.")
-        calorie_data = {}
-        calories_available = False
-
-    with open(ACTIVITY_FILE, "r") as f:
-        activity = json.load(f)
+)
+
+_DEFAULT_STRIDE_LENGTH_M: Final[float] = 0.762  # average adult stride
+
+_TRACKPOINT: Final[bytes] = (
+    b"<Trackpoint><Time>%s</Time>"
+    b"<HeartRateBpm><Value>%d</Value></HeartRateBpm>"
+    b"</Trackpoint>"
+)
+_TRACKPOINT_WITH_CALORIES: Final[bytes] = (
+    b"<Trackpoint><Time>%s</Time>"
+    b"<HeartRateBpm><Value>%d</Value></HeartRateBpm>"
+    b"<Extensions><ext:TPX><ext:Calories>%.5f</ext:Calories></ext:TPX></Extensions>"
+    b"</Trackpoint>"
+)
+
+
+def create_tcx(
+    heart_rate_file_path: pathlib.Path,
+    calories_file_path: pathlib.Path,
+    activity_file_path: pathlib.Path,
+    output_file_path: pathlib.Path,
+):
+    # Nothing to do if a previous run already converted this heart rate data
+    if (
+        output_file_path.exists()
+        and output_file_path.stat().st_mtime > heart_rate_file_path.stat().st_mtime
+    ):
+        print(f"✅ TCX file up to date: {os.path.abspath(output_file_path)}")
+        return
+
+    parsed = parse_activity.parse(
+        heart_rate_file_path, calories_file_path, activity_file_path
+    )
+    activity = parsed.activity
 
     # === Parse activity metadata ===
-    start_time_str = activity["startTime"]
-    start_time = datetime.fromisoformat(start_time_str)  # timezone-aware
-    tzinfo = start_time.tzinfo
+    start_time = parsed.start_time
 
     duration_ms = activity["duration"]
     total_seconds = duration_ms / 1000.0
@@ -66,53 +77,31 @@ def create_tcx(log_id: str):
 
     # Determine Fitbit activity type and Garmin sport
     fitbit_activity = activity.get("activityName", "Workout")
-    garmin_sport = FITBIT_TO_GARMIN_SPORT.get(fitbit_activity, "Other")
+    garmin_sport = _FITBIT_TO_GARMIN_SPORT.get(fitbit_activity, "Other")
 
     # === Handle distance or estimate from steps ===
     distance_km = activity.get("distance", 0.0)
     steps = activity.get("steps", 0)
 
     if distance_km == 0.0:
-        if steps > 0 and fitbit_activity in DISTANCE_RELEVANT_ACTIVITIES:
-            distance_km = (steps * DEFAULT_STRIDE_LENGTH_M) / 1000.0
+        if steps > 0 and fitbit_activity in _DISTANCE_RELEVANT_ACTIVITIES:
+            distance_km = (steps * _DEFAULT_STRIDE_LENGTH_M) / 1000.0
             print(
                 f"ℹ️  Estimated distance from {steps} steps for '{fitbit_activity}': {distance_km:.2f} km"
             )
         else:
             print(f"⚠️  No distance found for '{fitbit_activity}' — using 0.0 km.")
 
-    # === Parse heart rate dataset ===
-    hr_dataset = hr_data["activities-heart-intraday"]["dataset"]
-    hr_times = []
-    hr_values = []
-
-    date_str = hr_data["activities-heart"][0]["dateTime"]
-
-    for entry in hr_dataset:
-        dt_local_naive = datetime.strptime(
-            f"{date_str} {entry['time']}", "%Y-%m-%d %H:%M:%S"
-        )
-        dt_local = dt_local_naive.replace(tzinfo=tzinfo)
-        hr_times.append(dt_local)
-        hr_values.append(entry["value"])
-
-    max_hr = max(hr_values)
-    avg_hr = round(statistics.mean(hr_values))
-
-    # === Parse calorie dataset (1-min resolution) if available ===
-    calorie_map = {}
-    if calories_available:
-        try:
-            for entry in calorie_data["activities-calories-intraday"]["dataset"]:
-                dt_local_naive = datetime.strptime(
-                    f"{calorie_data['activities-calories'][0]['dateTime']} {entry['time']}",
-                    "%Y-%m-%d %H:%M:%S",
-                )
-                dt_local = dt_local_naive.replace(tzinfo=tzinfo)
-                calorie_map[dt_local.replace(second=0, microsecond=0)] = entry["value"]
-        except Exception as e:
-            print(f"⚠️  Failed to parse calorie data: {e}")
-            calories_available = False
+    max_hr = parsed.max_hr
+    avg_hr = parsed.avg_hr
+    calorie_map = parsed.cal_map
+
+    # Trackpoint times are written as local time, formatted in bulk
+    hr_time_strs = np.char.add(
+        np.datetime_as_string(parsed.hr_times, unit="s").astype("S"), b"Z"
+    )
+    hr_minutes = (parsed.hr_timestamps_ms // 60000).tolist()
+    hr_values = parsed.hr_values.tolist()
 
     # === TCX XML Setup ===
     ns = {
@@ -134,6 +123,9 @@ def create_tcx(log_id: str):
             "http://www.garmin.com/xmlschemas/TrainingCenterDatabasev2.xsd",
         },
     )
+    if calorie_map:
+        # Trackpoints are not part of the tree, so declare their namespace here
+        tcx.attrib = {"xmlns:ext": ns["ext"], **tcx.attrib}
 
     activities = ET.SubElement(tcx, "Activities")
     activity_elem = ET.SubElement(activities, "Activity", Sport=garmin_sport)
@@ -157,29 +149,8 @@ def create_tcx(log_id: str):
     ET.SubElement(lap, "Intensity").text = "Active"
     ET.SubElement(lap, "TriggerMethod").text = "Manual"
 
-    # === Build Trackpoints (with heart rate and optional calorie data) ===
-    track = ET.SubElement(lap, "Track")
-
-    for ts, hr in zip(hr_times, hr_values):
-        tp = ET.SubElement(track, "Trackpoint")
-        ET.SubElement(tp, "Time").text = ts.strftime("%Y-%m-%dT%H:%M:%SZ")
-
-        hr_elem = ET.SubElement(tp, "HeartRateBpm")
-        ET.SubElement(hr_elem, "Value").text = str(hr)
-
-        if calories_available:
-            min_key = ts.replace(second=0, microsecond=0)
-            cal_per_min = calorie_map.get(min_key)
-            if cal_per_min:
-                cal_per_sec = cal_per_min / 60.0
-                ext = ET.SubElement(tp, "Extensions")
-                tpx = ET.SubElement(
-                    ext, "{http://www.garmin.com/xmlschemas/ActivityExtension/v2}TPX"
-                )
-                ET.SubElement(
-                    tpx,
-                    "{http://www.garmin.com/xmlschemas/ActivityExtension/v2}Calories",
-                ).text = f"{cal_per_sec:.5f}"
+    # Trackpoints are spliced in as raw bytes when writing the output
+    ET.SubElement(lap, "Track")
 
     # === Add Creator Info ===
     creator = ET.SubElement(activity_elem, "Creator", {"xsi:type": "Device_t"})
@@ -188,6 +159,26 @@ def create_tcx(log_id: str):
     ET.SubElement(creator, "ProductID").text = "0"
 
     # === Write TCX Output ===
-    tree = ET.ElementTree(tcx)
-    tree.write(OUTPUT_FILE, encoding="UTF-8", xml_declaration=True)
-    print(f"\n✅ TCX file written to: {os.path.abspath(OUTPUT_FILE)}")
+    header, footer = ET.tostring(tcx, encoding="UTF-8", xml_declaration=True).split(
+        b"<Track />"
+    )
+
+    # Trackpoints (with heart rate and optional calorie data) are streamed
+    # straight to the file, so memory stays flat however long the activity is.
+    # The file is only moved into place once complete, so an interrupted run
+    # never leaves a truncated TCX that looks converted.
+    tmp_file_path = output_file_path.with_suffix(output_file_path.suffix + ".tmp")
+    with tmp_file_path.open("wb") as fw:
+        fw.write(header)
+        fw.write(b"<Track>")
+        for ts, minute, hr in zip(hr_time_strs.tolist(), hr_minutes, hr_values):
+            cal_per_min = calorie_map.get(minute)
+            if cal_per_min:
+                cal_per_sec = cal_per_min / 60.0
+                fw.write(_TRACKPOINT_WITH_CALORIES % (ts, hr, cal_per_sec))
+            else:
+                fw.write(_TRACKPOINT % (ts, hr))
+        fw.write(b"</Track>")
+        fw.write(footer)
+    os.replace(tmp_file_path, output_file_path)
+    print(f"\n✅ TCX file written to: {os.path.abspath(output_file_path)}")
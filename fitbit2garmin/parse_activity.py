@@ -0,0 +1,99 @@
+import pathlib
+from dataclasses import dataclass
+from datetime import date, datetime, time
+from typing import Any, Dict
+
+import numpy as np
+import orjson
+
+
+@dataclass
+class ParsedActivity:
+    activity: Dict[str, Any]
+    start_time: datetime  # timezone-aware
+    # Heart rate samples, one entry per sample
+    hr_times: np.ndarray  # local time, datetime64[s]
+    hr_timestamps_ms: np.ndarray  # UTC epoch milliseconds, int64
+    hr_values: np.ndarray  # bpm, int16
+    min_hr: int
+    max_hr: int
+    avg_hr: int
+    # Calories burned per minute, keyed by UTC epoch minute
+    cal_map: Dict[int, float]
+
+
+def _local_midnight_epoch(day: date, start_time: datetime) -> int:
+    return int(datetime.combine(day, time.min, start_time.tzinfo).timestamp())
+
+
+def _seconds_of_day(t: str) -> int:
+    # "HH:MM:SS", much cheaper than strptime/fromisoformat per sample
+    return int(t[0:2]) * 3600 + int(t[3:5]) * 60 + int(t[6:8])
+
+
+def parse(
+    heart_rate_file_path: pathlib.Path,
+    calories_file_path: pathlib.Path,
+    activity_file_path: pathlib.Path,
+) -> ParsedActivity:
+    # === Load all data ===
+    hr_data = orjson.loads(heart_rate_file_path.read_bytes())
+
+    try:
+        calorie_data = orjson.loads(calories_file_path.read_bytes())
+    except FileNotFoundError:
+        print("⚠️  Calories file not found. Skipping per-minute calorie data.")
+        calorie_data = None
+
+    activity = orjson.loads(activity_file_path.read_bytes())
+
+    # === Parse activity metadata ===
+    start_time_str = activity["startTime"]
+    start_time = datetime.fromisoformat(start_time_str)  # timezone-aware
+
+    # === Parse heart rate dataset ===
+    hr_dataset = hr_data["activities-heart-intraday"]["dataset"]
+    hr_date = date.fromisoformat(hr_data["activities-heart"][0]["dateTime"])
+    hr_base_epoch = _local_midnight_epoch(hr_date, start_time)
+
+    # Samples are local "HH:MM:SS" times of the activity day
+    hr_seconds = np.fromiter(
+        (_seconds_of_day(entry["time"]) for entry in hr_dataset),
+        dtype=np.int64,
+        count=len(hr_dataset),
+    )
+    hr_times = np.datetime64(hr_date, "s") + hr_seconds
+    hr_timestamps_ms = (hr_base_epoch + hr_seconds) * 1000
+    hr_values = np.fromiter(
+        (entry["value"] for entry in hr_dataset), dtype=np.int16, count=len(hr_dataset)
+    )
+
+    if not hr_values.size:
+        raise RuntimeError("No heart rate data available")
+
+    # === Parse calorie dataset (1-min resolution) if available ===
+    cal_map = {}
+    if calorie_data is not None:
+        try:
+            cal_date = date.fromisoformat(
+                calorie_data["activities-calories"][0]["dateTime"]
+            )
+            cal_base_epoch = _local_midnight_epoch(cal_date, start_time)
+            for entry in calorie_data["activities-calories-intraday"]["dataset"]:
+                epoch = cal_base_epoch + _seconds_of_day(entry["time"])
+                cal_map[epoch // 60] = entry["value"]
+        except Exception as e:
+            print(f"⚠️  Failed to parse calorie data: {e}")
+            cal_map = {}
+
+    return ParsedActivity(
+        activity=activity,
+        start_time=start_time,
+        hr_times=hr_times,
+        hr_timestamps_ms=hr_timestamps_ms,
+        hr_values=hr_values,
+        min_hr=int(hr_values.min()),
+        max_hr=int(hr_values.max()),
+        avg_hr=round(float(hr_values.mean())),
+        cal_map=cal_map,
+    )